@@ -1,9 +1,28 @@
+import logging
+import os
+import re
+import sys
 import threading
 import time
+from contextlib import asynccontextmanager
 import serial
 import serial.tools.list_ports
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+
+# Logger del servicio. Uvicorn solo configura sus propios loggers, así que
+# a este se le da aquí su handler y nivel INFO (sin tocar el logger raíz ni
+# el de otras librerías), salvo que ya venga configurado, p. ej. con
+# --log-config. Los mensajes del ciclo de lectura van a DEBUG y se
+# descartan sin formatear.
+log = logging.getLogger(__name__)
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log.addHandler(_log_handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
 
 origins = [
     "http://localhost",
@@ -13,7 +32,38 @@ origins = [
     "https://inventarios.bluepacificoils.com"
 ]
 
-app = FastAPI()
+# Solo el proceso lanzado con SERIAL_OWNER=1 crea la BalanzaApp y abre el
+# puerto serial. La variable se define por proceso (ver start_scale.bat):
+# con "uvicorn --workers N" o gunicorn todos los workers heredan el mismo
+# entorno, así que el lector debe ser un proceso propio y de un solo worker.
+SERIAL_OWNER = os.environ.get("SERIAL_OWNER") == "1"
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Crea la BalanzaApp al arrancar el servicio (no al importar el módulo),
+    solo si este proceso es el dueño del puerto, y detiene la lectura al
+    apagarlo.
+    """
+    if SERIAL_OWNER:
+        app.state.balanza = BalanzaApp()
+    else:
+        log.warning(
+            "SERIAL_OWNER no es 1: este proceso no abrirá el puerto serial y "
+            "/weight/, /iniciar y /detener responderán 409."
+        )
+    yield
+    if app.state.balanza is not None:
+        try:
+            app.state.balanza.stop()
+        except Exception:
+            # Un fallo al cerrar el puerto no debe romper el apagado
+            log.exception("No se pudo detener la lectura al apagar el servicio.")
+
+
+app = FastAPI(lifespan=lifespan)
+app.state.balanza = None
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,20 +76,66 @@ app.add_middleware(
 
 
 # ------------------------------------------------------------------
-# 1) FUNCIÓN PARA TRANSFORMAR LA TRAMA (sin cambios)
+# 1) FUNCIÓN PARA TRANSFORMAR LA TRAMA
 # ------------------------------------------------------------------
+# Tabla de traducción precalculada: 0x80..0xFF -> 0x00..0x7F,
+# 0x00..0x7F quedan igual.
+_XLAT = bytes.maketrans(bytes(range(256)), bytes(i & 0x7F for i in range(256)))
+
+# Formato continuo de la balanza: STX + 3 bytes de estado + 6 de peso
+# + 6 de tara + CR. El peso va en las posiciones 4..9 desde el STX (como
+# ya asumía el código original). El largo total se tomó del formato
+# continuo estándar de Mettler Toledo y no está confirmado con el manual
+# de esta balanza, por eso solo se usa para saber cuándo hay una trama
+# completa y nunca para rechazarla.
+FRAME_LEN = 17
+
+# Máximo de bytes a leer del puerto por ciclo.
+READ_MAX = 4096
+
+# Segundos sin una trama válida tras los cuales el peso pasa a '----'
+# (el intervalo del Timer original).
+SIN_DATOS_SEG = 0.25
+
+# Segundos durante los que se reutiliza la lista de puertos de /puertos.
+PUERTOS_TTL_SEG = 2.0
+
+# Inicio de trama (STX), con o sin el bit alto (0x02 / 0x82).
+_STX = re.compile(b'[\x02\x82]')
+
+# Bytes que no pueden aparecer en el campo de peso (ya transformado):
+# todo salvo dígitos, punto, signo y espacio. Se usa como tabla de borrado.
+_PESO_INVALIDO = bytes(b for b in range(256) if chr(b) not in "0123456789.- ")
+
+# Todo lo que no es dígito; al borrarlo queda cuántos dígitos tiene el peso.
+_NO_DIGITO = bytes(b for b in range(256) if chr(b) not in "0123456789")
+
+
 def transformar_trama(trama):
     """
-    Resta 0x80 a cada caracter cuyo código sea >= 0x80.
+    Resta 0x80 a cada byte cuyo código sea >= 0x80.
     Esto convierte, por ejemplo, 0x82 en 0x02 y 0x8D en 0x0D.
+    Trabaja directamente sobre bytes o bytearray (sin decodificar ni copiar
+    a bytes antes) y devuelve el mismo tipo que recibe.
     """
-    nueva = ""
-    for c in trama:
-        if ord(c) >= 0x80:
-            nueva += chr(ord(c) - 0x80)
-        else:
-            nueva += c
-    return nueva
+    return trama.translate(_XLAT)
+
+
+# Última enumeración de puertos: [instante monotonic, lista]
+_ports_cache = [float("-inf"), []]
+
+
+def puertos_disponibles():
+    """
+    Devuelve los puertos seriales del sistema. No toca el puerto de la
+    balanza, así que sirve en cualquier proceso. Enumerar puertos es lento
+    en Windows, por eso el resultado se reutiliza PUERTOS_TTL_SEG segundos.
+    """
+    now = time.monotonic()
+    if now - _ports_cache[0] > PUERTOS_TTL_SEG:
+        ports = serial.tools.list_ports.comports()
+        _ports_cache[:] = [now, [p.device for p in ports]]
+    return _ports_cache[1]
 
 
 # ------------------------------------------------------------------
@@ -48,8 +144,8 @@ def transformar_trama(trama):
 # ------------------------------------------------------------------
 class BalanzaApp:
     def __init__(self):
-        # Variable para acumular la trama recibida
-        self.cPeso = ""
+        # Variable para acumular la trama recibida (bytes crudos)
+        self.cPeso = bytearray()
 
         # ---------------------------
         # CONFIGURACIÓN SERIAL
@@ -60,27 +156,79 @@ class BalanzaApp:
         self.oComm.parity = serial.PARITY_NONE
         self.oComm.bytesize = serial.EIGHTBITS
         self.oComm.stopbits = serial.STOPBITS_ONE
-        self.oComm.timeout = 0  # Lectura no bloqueante
+        # Lectura bloqueante con timeout corto: read(n) espera hasta tener
+        # los n bytes pedidos o hasta que vencen 50 ms, lo que ocurra
+        # primero. Cuántos bytes se piden lo decide oTimer_Tick.
+        self.oComm.timeout = 0.05
 
         # Almacenamos los valores que antes iban en "Entry" de Tkinter
         self.txtPeso = "----"
         self.txtTrama = ""
 
-        # Intervalo del "timer" en milisegundos (en Tkinter era 250 ms).
-        # Aquí lo convertimos a segundos (0.25) para el hilo.
-        self.timer_interval = 0.25
-        self.timer_active = False
+        # Protege la publicación conjunta de txtPeso/txtTrama frente a los
+        # endpoints, que leen desde otro hilo.
+        self._lock = threading.Lock()
+
+        # Señal de parada del hilo lector. Arranca "puesta" (detenido);
+        # al marcarla, el hilo sale en cuanto vuelve de read().
+        self._stop = threading.Event()
+        self._stop.set()
 
         # Hilo de lectura en segundo plano
         self._thread = None
 
+    @property
+    def timer_active(self):
+        """
+        True mientras el hilo lector esté activo (equivale al Timer
+        encendido del GUI original).
+        """
+        return not self._stop.is_set()
+
     def get_serial_ports(self):
         """
         Devuelve una lista de puertos seriales disponibles en el sistema.
         (En el original se usaba para llenar el Combobox)
         """
-        ports = serial.tools.list_ports.comports()
-        return [p.device for p in ports]
+        return puertos_disponibles()
+
+    def _publicar(self, peso, trama):
+        """
+        Actualiza txtPeso y txtTrama juntos, bajo el lock, para que los
+        endpoints nunca vean un peso con la trama de otra lectura.
+        """
+        with self._lock:
+            self.txtPeso = peso
+            self.txtTrama = trama
+
+    def stop(self):
+        """
+        Detiene la lectura y cierra el puerto si está activa.
+        Se usa al apagar el servicio.
+        """
+        if self.timer_active:
+            self.toggle_connection()
+
+    def _ajustar_baja_latencia(self):
+        """
+        Solo Linux, y sin fallar si no aplica: baja a 1 ms el latency_timer
+        de los adaptadores USB FTDI (16 ms por defecto) y activa
+        ASYNC_LOW_LATENCY en el puerto. En Windows (COMx) no hace nada.
+        """
+        if not sys.platform.startswith("linux"):
+            return
+
+        nombre = os.path.basename(self.oComm.port)
+        try:
+            with open(f"/sys/bus/usb-serial/devices/{nombre}/latency_timer", "w") as f:
+                f.write("1")
+        except OSError as e:
+            log.debug("No se pudo ajustar latency_timer de %s: %s", nombre, e)
+
+        try:
+            self.oComm.set_low_latency_mode(True)
+        except (AttributeError, OSError, ValueError) as e:
+            log.debug("No se pudo activar ASYNC_LOW_LATENCY en %s: %s", nombre, e)
 
     def toggle_connection(self):
         """
@@ -91,23 +239,28 @@ class BalanzaApp:
             # Emula la acción "INICIAR":
             try:
                 # Abrimos el puerto
-                print(f"[DEBUG] Abriendo puerto: {self.oComm.port}")
+                log.info("Abriendo puerto: %s", self.oComm.port)
                 self.oComm.open()
-
-                # Activamos la bandera y lanzamos el hilo
-                self.timer_active = True
+                self._ajustar_baja_latencia()
+
+                # Activamos la bandera y lanzamos el hilo.
+                # Se mantiene un hilo dedicado (y no pyserial-asyncio) porque
+                # en Windows (COMx) pyserial-asyncio no espera eventos del SO:
+                # sondea el puerto cada pocos ms, que es justo lo que evitamos
+                # con el read() bloqueante.
+                self._stop.clear()
                 self._thread = threading.Thread(target=self.oTimer_Tick, daemon=True)
                 self._thread.start()
 
-                print("[DEBUG] Puerto abierto y Timer iniciado.")
+                log.info("Puerto abierto y Timer iniciado.")
             except Exception as e:
-                print(f"[ERROR] No se pudo abrir el puerto: {e}")
+                log.error("No se pudo abrir el puerto: %s", e)
                 raise e
         else:
             # Emula la acción "DETENER":
             try:
-                print("[DEBUG] Deteniendo lectura y cerrando puerto.")
-                self.timer_active = False
+                log.info("Deteniendo lectura y cerrando puerto.")
+                self._stop.set()
 
                 # Esperamos a que el hilo termine su ciclo
                 if self._thread is not None:
@@ -115,100 +268,191 @@ class BalanzaApp:
 
                 if self.oComm.is_open:
                     self.oComm.close()
-                    print("[DEBUG] Puerto cerrado correctamente.")
+                    log.info("Puerto cerrado correctamente.")
 
                 # Restablecemos el campo de peso y la trama
-                self.txtPeso = "0"
-                self.cPeso = ""
-                print("[DEBUG] Lectura detenida.")
+                self._publicar("0", "")
+                self.cPeso.clear()
+                log.info("Lectura detenida.")
             except Exception as e:
-                print(f"[ERROR] No se pudo cerrar el puerto: {e}")
+                log.error("No se pudo cerrar el puerto: %s", e)
                 raise e
 
     def oTimer_Tick(self):
         """
-        Función que imita el 'after()' de Tkinter: se ejecuta mientras
-        'self.timer_active' sea True, cada 250 ms (0.25 seg).
-        Acumula bytes en self.cPeso y, cuando supera cierto largo, procesa la trama.
+        Función que imita el 'after()' de Tkinter: se ejecuta hasta que se
+        marca 'self._stop'. En lugar de dormir 250 ms entre ciclos,
+        se bloquea en read() hasta completar una trama o hasta que vence el
+        timeout del puerto (50 ms), por lo que la detención tarda a lo sumo
+        ese tiempo. Acumula bytes en self.cPeso, se sincroniza con el STX y
+        procesa todas las tramas de FRAME_LEN bytes que estén completas.
+        Todo el ciclo trabaja con bytes crudos: solo se decodifican a texto
+        los 6 bytes del peso de la última trama.
         """
-        while self.timer_active:
+        # Referencias locales: evitan resolver atributos en cada ciclo.
+        # cPeso nunca se reasigna (se vacía in situ), así que es seguro.
+        comm = self.oComm
+        read = comm.read
+        cPeso = self.cPeso
+        cPeso_extend = cPeso.extend
+        stx_search = _STX.search
+        stop_is_set = self._stop.is_set
+        monotonic = time.monotonic
+        ultima_trama = monotonic()
+
+        # El estado del puerto se comprueba una sola vez; si se desconecta
+        # o se cierra durante la lectura, read() lanza la excepción.
+        if not comm.is_open:
+            self._stop.set()
+            return
+
+        try:
+            while not stop_is_set():
+                # Espera (bloqueante, con timeout) al menos lo que falta para
+                # completar una trama, así el hilo despierta una vez por trama
+                # y no por cada byte; si el driver ya tiene más, lo drena de
+                # una vez.
+                data = read(min(max(FRAME_LEN - len(cPeso), comm.in_waiting, 1), READ_MAX))
+                if data:
+                    cPeso_extend(data)
+                    log.debug("Datos recibidos: %r", data)
+
+                # Recorremos todas las tramas completas del acumulador;
+                # solo interesa la última (la más reciente).
+                inicio = 0
+                ultima = -1
+                while True:
+                    # Sincronizamos con el inicio de trama (STX, \x02). Con el
+                    # bit alto encendido llega como \x82, así que buscamos ambos.
+                    m = stx_search(cPeso, inicio)
+                    if m is None:
+                        if ultima == -1 and len(cPeso) - inicio >= FRAME_LEN:
+                            log.debug("No se encontró el carácter STX en la trama.")
+                            self._publicar("----", "")
+                        # Sin STX no hay nada aprovechable en el resto
+                        consumido = len(cPeso)
+                        break
+
+                    pos = m.start()
+                    if len(cPeso) - pos < FRAME_LEN:
+                        # Trama incompleta: la conservamos desde su STX y
+                        # esperamos el resto.
+                        consumido = pos
+                        break
+
+                    # STX + 3 bytes de estado: el peso son los 6 siguientes.
+                    # Solo se transforman esos 6 bytes, y la trama se acepta
+                    # únicamente si todos son válidos (dígitos, punto, signo o
+                    # espacio) y hay al menos un dígito; si no, era ruido y se
+                    # busca el siguiente STX.
+                    candidato = transformar_trama(cPeso[pos + 4:pos + 10])
+                    if (len(candidato.translate(None, _PESO_INVALIDO)) != 6
+                            or not candidato.translate(None, _NO_DIGITO)):
+                        log.debug("Trama descartada, peso inválido: %r", candidato)
+                        inicio = pos + 1
+                        continue
+
+                    ultima = pos
+                    weight = candidato
+                    inicio = pos + FRAME_LEN
+
+                if ultima != -1:
+                    log.debug("Peso extraído: %r", weight)
+                    # La trama se publica cruda, en hexadecimal (útil para
+                    # depurar y sin caracteres de control en el JSON).
+                    trama_hex = cPeso[ultima:ultima + FRAME_LEN].hex()
+                    log.debug("Trama: %s", trama_hex)
+
+                    self._publicar(weight.decode('ascii', 'ignore'), trama_hex)
+                    ultima_trama = monotonic()
+                elif monotonic() - ultima_trama >= SIN_DATOS_SEG:
+                    # Sin tramas válidas (línea en silencio, sobrecarga o
+                    # guiones): no seguimos mostrando el último peso como
+                    # si fuera actual.
+                    self._publicar("----", "")
+                    if not data:
+                        # La línea calló a mitad de trama: ese resto ya no
+                        # se va a completar.
+                        consumido = len(cPeso)
+
+                # Descartamos de una vez todo lo ya procesado
+                del cPeso[:consumido]
+        except Exception as e:
+            log.exception("Error de lectura: %s", e)
+            # Detenemos todo si ocurre un error
+            self._stop.set()
             try:
-                if self.oComm.is_open:
-                    in_waiting = self.oComm.in_waiting
-                    if in_waiting > 0:
-                        # Lee todos los bytes disponibles
-                        data = self.oComm.read(in_waiting)
-                        chunk = data.decode('latin-1', errors='ignore')
-                        self.cPeso += chunk
-                        print(f"[DEBUG] Datos recibidos: {chunk}")
-
-                    # Si se acumula una trama suficientemente larga (>= 30 caracteres)
-                    if len(self.cPeso) >= 30:
-                        print(f"[DEBUG] Trama completa (>=30 chars): {self.cPeso}")
-                        # Transforma la trama
-                        trama_corregida = transformar_trama(self.cPeso)
-                        print(f"[DEBUG] Trama corregida: {trama_corregida}")
-
-                        self.txtTrama = trama_corregida
-
-                        # Buscamos el carácter de inicio (STX, \x02)
-                        pos = trama_corregida.find('\x02')
-                        if pos != -1:
-                            # sumamos 4 para llegar al inicio del peso
-                            start_idx = pos + 4
-                            # Extraemos 6 caracteres
-                            weight = trama_corregida[start_idx:start_idx+6]
-                            print(f"[DEBUG] Peso extraído: {weight}")
-                            self.txtPeso = weight
-                        else:
-                            print("[DEBUG] No se encontró el carácter STX en la trama corregida.")
-                            self.txtPeso = "----"
-
-                        # Reiniciamos la acumulación para la siguiente trama
-                        self.cPeso = ""
-                    else:
-                        # Si no hay datos acumulados, muestra '----'
-                        if len(self.cPeso) == 0:
-                            self.txtPeso = "----"
-            except Exception as e:
-                print(f"[ERROR] Error de lectura: {e}")
-                # Detenemos todo si ocurre un error
-                self.timer_active = False
-                try:
-                    if self.oComm.is_open:
-                        self.oComm.close()
-                except:
-                    pass
-
-            # Espera antes de la siguiente iteración
-            time.sleep(self.timer_interval)
+                if comm.is_open:
+                    comm.close()
+            except:
+                pass
 
 
 # ------------------------------------------------------------------
-# 3) INSTANCIA GLOBAL DE BalanzaApp
+# 3) ENDPOINTS EN FASTAPI
 # ------------------------------------------------------------------
-balanza = BalanzaApp()
 
-# ------------------------------------------------------------------
-# 4) ENDPOINTS EN FASTAPI
-# ------------------------------------------------------------------
+def obtener_balanza():
+    """
+    Devuelve la BalanzaApp de este proceso. Si no es el dueño del puerto
+    (SERIAL_OWNER), responde 409.
+    """
+    balanza = app.state.balanza
+    if balanza is None:
+        raise HTTPException(status_code=409, detail="Este proceso no es el dueño del puerto serial.")
+    return balanza
+
+
+# Última fecha formateada: [segundo epoch, "YYYY-mm-dd HH:MM:SS"]
+_ts_cache = [0, ""]
+
+
+def fecha_y_hora_actual():
+    """
+    Devuelve la fecha y hora local formateada. Se formatea una sola vez
+    por segundo; el resto de peticiones de ese segundo reutilizan el texto.
+    """
+    now = int(time.time())
+    if now != _ts_cache[0]:
+        _ts_cache[:] = [now, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))]
+    return _ts_cache[1]
+
+
+# /weight/ es async: solo lee memoria y no bloquea, así se atiende en el
+# event loop sin pasar por el threadpool. /iniciar, /detener y /puertos
+# siguen siendo def porque abren/cierran el puerto o enumeran dispositivos
+# (E/S bloqueante que no debe frenar el event loop).
+class EstadoPeso(BaseModel):
+    """Respuesta de /weight/."""
+    peso: str
+    trama: str
+    timer_active: bool
+    fecha_and_time: str
+
 
 @app.get("/weight/")
-def home():
+async def home() -> EstadoPeso:
     """
     Endpoint simple que devuelve el estado actual:
     - Peso leído (txtPeso)
-    - Última trama recibida (txtTrama)
+    - Última trama recibida, cruda y en hexadecimal (txtTrama)
     - Si está activo el 'timer' (timer_active)
     """
-    fecha_y_hora = time.strftime("%Y-%m-%d %H:%M:%S")
-    
-    return {
-        "peso": balanza.txtPeso,
-        "trama": balanza.txtTrama,
-        "timer_active": balanza.timer_active,
-        'fecha_and_time': fecha_y_hora
-    }
+    balanza = obtener_balanza()
+    fecha_y_hora = fecha_y_hora_actual()
+
+    # Tomamos una foto consistente del estado (el hilo lector lo actualiza)
+    with balanza._lock:
+        peso, trama, activo = balanza.txtPeso, balanza.txtTrama, balanza.timer_active
+
+    # Con el tipo de retorno declarado, FastAPI serializa el modelo
+    # directamente con Pydantic.
+    return EstadoPeso(
+        peso=peso,
+        trama=trama,
+        timer_active=activo,
+        fecha_and_time=fecha_y_hora,
+    )
 
 
 @app.post("/iniciar")
@@ -216,7 +460,9 @@ def iniciar_lectura():
     """
     Llama al toggle_connection() solo si no está activo.
     Equivale al botón "Iniciar" en el GUI original.
+    Se rechaza si este proceso no es el dueño del puerto (SERIAL_OWNER).
     """
+    balanza = obtener_balanza()
     if not balanza.timer_active:
         balanza.toggle_connection()
         return {"message": "Lectura iniciada en COM4."}
@@ -230,6 +476,7 @@ def detener_lectura():
     Llama al toggle_connection() solo si está activo.
     Equivale al botón "Detener" en el GUI original.
     """
+    balanza = obtener_balanza()
     if balanza.timer_active:
         balanza.toggle_connection()
         return {"message": "Lectura detenida."}
@@ -243,4 +490,4 @@ def listar_puertos():
     (Opcional) Retorna la lista de puertos disponibles, 
     aunque en este ejemplo la app está fijada a COM4.
     """
-    return balanza.get_serial_ports()
+    return puertos_disponibles()
@@ -1,3 +1,6 @@
 @echo off
 call D:\BPO\BPO-ABack\env\Scripts\activate
+rem Este proceso es el unico que abre el puerto serial de la balanza.
+rem Debe correr con un solo worker: los workers heredan SERIAL_OWNER.
+set SERIAL_OWNER=1
 uvicorn main:app --host 0.0.0.0 --port 8000
\ No newline at end of file